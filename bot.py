@@ -21,9 +21,16 @@ from telegram.ext import (
 )
 from functools import lru_cache
 from collections import defaultdict
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+import queue
 import threading
 import time
+import multiprocessing
+import socket
+from urllib.parse import urlparse
+from session_store import create_session_store, SessionConflict
+from portal_calendar import PortalCalendar
 
 # === ЛОГИРОВАНИЕ ТОЛЬКО В bot.log ===
 logging.basicConfig(
@@ -39,9 +46,21 @@ logger = logging.getLogger(__name__)
 ephemeris_path = os.path.join(os.path.dirname(__file__), "ephemeris")
 swe.set_ephe_path(ephemeris_path)
 
-geolocator = Nominatim(user_agent="jyotishportal_bot")
+# Адреса внешних сервисов можно подменить (например, локальными заглушками в loadtest.py)
+KP_URL_TEMPLATE = os.getenv("KP_URL_TEMPLATE", "https://xras.ru/txt/kp_BPE3_{date}.json")
+geolocator = Nominatim(
+    user_agent="jyotishportal_bot",
+    domain=os.getenv("NOMINATIM_DOMAIN", "nominatim.openstreetmap.org"),
+    scheme=os.getenv("NOMINATIM_SCHEME", "https")
+)
 tf = TimezoneFinder()
 
+# Сессии пользователей (пагинация, результаты, ход поиска) — общие для всех воркеров
+session_store = create_session_store()
+SESSION_TTL = 7 * 24 * 3600
+SCAN_TIMEOUT = 600  # сек — поиск со статусом running старше этого считается прерванным
+active_scans = set()  # user_id поисков, идущих в этом процессе
+
 # === СПИСОК ГОРОДОВ И КООРДИНАТЫ ===
 RUSSIAN_CITIES = [
     "Абакан", "Анадырь", "Архангельск", "Астрахань", "Барнаул", "Белгород",
@@ -87,23 +106,50 @@ def health_check():
     return jsonify({"status": "ok", "service": "JyotishPortal_Bot"})
 
 # === Kp-ИНДЕКС ===
-kp_cache = defaultdict(lambda: (None, 0))
+KP_CACHE_TTL = 43200  # сек — для окончательных значений Kp
+KP_FALLBACK_TTL = 600  # сек — для заменителя 2.0 и Kp ещё не закончившегося дня
+KP_SLOTS_PER_DAY = 8  # трёхчасовые значения h00…h21
+
+# date → (Kp, время запроса, окончательное ли значение)
+kp_cache = defaultdict(lambda: (None, 0, False))
 
 def get_kp_index(date):
-    current_time = datetime.datetime.now().timestamp()
-    if date in kp_cache and current_time - kp_cache[date][1] < 43200:
-        cached_value, _ = kp_cache[date]
-        if cached_value is not None:
-            return cached_value
+    return get_kp_status(date)[0]
+
+def get_cached_kp(date):
+    """(Kp, окончательное ли) из кэша без обращения к xras.ru; None — нужно загрузить"""
+    if date.year < 2000:
+        return 2.0, True
+    if date in kp_cache:
+        cached_value, cached_time, final = kp_cache[date]
+        ttl = KP_CACHE_TTL if final else KP_FALLBACK_TTL
+        if cached_value is not None and datetime.datetime.now().timestamp() - cached_time < ttl:
+            return cached_value, final
+    return None
+
+def get_kp_status(date):
+    """
+    Возвращает (Kp, окончательное ли значение). Окончательное — данные
+    за уже прошедший день (UTC), в которых опубликованы все 8 трёхчасовых
+    значений, или дата до 2000 года, где данных нет вовсе.
+    Заменитель 2.0 при сбое xras.ru и неполный Kp (текущий день, вчерашний
+    сразу после полуночи) кэшируются ненадолго и остаются неокончательными.
+    Дата, за которую xras.ru так и не отдаёт данных, тоже остаётся
+    неокончательной: календарь перезапрашивает и пересчитывает её
+    каждые CALENDAR_REFRESH без ограничения срока.
+    """
+    cached = get_cached_kp(date)
+    if cached is not None:
+        return cached
 
+    current_time = datetime.datetime.now().timestamp()
     try:
-        if date.year < 2000:
-            return 2.0
         date_str = date.strftime("%Y%m%d")
-        url = f"https://xras.ru/txt/kp_BPE3_{date_str}.json"  # 🔥 УБРАН ПРОБЕЛ!
+        url = KP_URL_TEMPLATE.format(date=date_str)
         response = requests.get(url, timeout=10)
         if response.status_code != 200:
-            return 2.0
+            kp_cache[date] = (2.0, current_time, False)
+            return 2.0, False
         data = response.json()
         target_date_str = date.strftime("%Y-%m-%d")
         for day_data in data.get("data", []):
@@ -119,14 +165,16 @@ def get_kp_index(date):
                             continue
                 if kp_values:
                     avg_kp = sum(kp_values) / len(kp_values)
-                    kp_cache[date] = (avg_kp, current_time)
-                    return avg_kp
-        kp_cache[date] = (2.0, current_time)
-        return 2.0
+                    final = (len(kp_values) == KP_SLOTS_PER_DAY
+                             and date < datetime.datetime.now(pytz.UTC).date())
+                    kp_cache[date] = (avg_kp, current_time, final)
+                    return avg_kp, final
+        kp_cache[date] = (2.0, current_time, False)
+        return 2.0, False
     except Exception as e:
         logger.error(f"Ошибка Kp: {e}")
-        kp_cache[date] = (2.0, current_time)
-        return 2.0
+        kp_cache[date] = (2.0, current_time, False)
+        return 2.0, False
 
 def is_night(lat, lon, dt):
     try:
@@ -169,8 +217,27 @@ def calculate_astrology(lat, lon, dt):
         "nakshatra": nakshatra
     }
 
-@lru_cache(maxsize=365)
+PORTAL_LABELS = {
+    1: "✅ Тип 1 (Геопортал)",
+    2: "🌤 Тип 2 (Атмосферный)",
+    4: "💥 Тип 4 (Аварийный)",
+    5: "👁️ Тип 5 (Наблюдательный)",
+}
+NO_PORTAL = "❌ Вне системы"
+
+def get_portal_type(event_type):
+    """Номер типа портала по подписи классификации (None — вне системы)"""
+    for portal_type, label in PORTAL_LABELS.items():
+        if label == event_type:
+            return portal_type
+    return None
+
+@lru_cache(maxsize=4096)
 def get_event_analysis(lat, lon, dt):
+    return classify_event(lat, lon, dt)
+
+def classify_event(lat, lon, dt):
+    """Классификация без кэша — для пересчёта календаря при обновлении Kp"""
     astro_data = calculate_astrology(lat, lon, dt)
     moon_pos = astro_data["moon"]
     rahu_pos = astro_data["rahu"]
@@ -193,15 +260,15 @@ def get_event_analysis(lat, lon, dt):
     cond6 = kp <= 5
 
     if (cond1 or cond3 or cond5) and cond2 and cond4 and cond6:
-        return "✅ Тип 1 (Геопортал)"
+        return PORTAL_LABELS[1]
     elif (in_8th or in_12th) and cond3 and cond6:
-        return "🌤 Тип 2 (Атмосферный)"
+        return PORTAL_LABELS[2]
     elif cond1 and (in_8th or in_12th or in_mula) and kp >= 6:
-        return "💥 Тип 4 (Аварийный)"
+        return PORTAL_LABELS[4]
     elif cond6 and cond5 and (cond1 or cond3):
-        return "👁️ Тип 5 (Наблюдательный)"
+        return PORTAL_LABELS[5]
     else:
-        return "❌ Вне системы"
+        return NO_PORTAL
 
 # === КЛАВИАТУРЫ ===
 def build_city_keyboard(offset=0, limit=10):
@@ -258,9 +325,12 @@ def build_quarter_keyboard():
         [InlineKeyboardButton("🔚 Отмена", callback_data="cancel")]
     ])
 
-def build_year_keyboard():
+def get_offered_years():
     current_year = datetime.datetime.now().year
-    years = list(range(current_year - 3, current_year + 4))
+    return list(range(current_year - 3, current_year + 4))
+
+def build_year_keyboard():
+    years = get_offered_years()
     buttons = []
     for i in range(0, len(years), 3):
         buttons.append([InlineKeyboardButton(str(y), callback_data=f"year:{y}") for y in years[i:i+3]])
@@ -287,10 +357,73 @@ def build_results_keyboard(results, page=0, per_page=10, mode="single", current_
     buttons.append(InlineKeyboardButton("🔚 Завершить", callback_data="cancel"))
     return InlineKeyboardMarkup([buttons] if buttons else [[InlineKeyboardButton("🔚 Завершить", callback_data="cancel")]])
 
+# === МАТЕРИАЛИЗОВАННЫЙ КАЛЕНДАРЬ ПОРТАЛОВ ===
+CALENDAR_PATH = os.getenv("CALENDAR_PATH", "portal_calendar.bin")
+CALENDAR_REFRESH = 3 * 3600  # сек между пересчётами дней без окончательного Kp
+
+portal_calendar = PortalCalendar(CALENDAR_PATH, CITY_COORDS, get_offered_years())
+
+def calendar_day_dt(date):
+    # Как и в analyze_period, день классифицируется на 15:00 UTC
+    return datetime.datetime(date.year, date.month, date.day, 15, tzinfo=pytz.UTC)
+
+def compute_calendar_day(date):
+    """Пересчитывает один день для всех городов календаря"""
+    dt = calendar_day_dt(date)
+    _, kp_final = get_kp_status(date)  # один запрос Kp на дату для всех городов
+    for city, (lat, lon) in CITY_COORDS.items():
+        try:
+            portal_calendar.set(city, date, get_portal_type(classify_event(lat, lon, dt)), kp_final)
+        except Exception as e:
+            logger.warning(f"Календарь: ошибка для {city} {date}: {e}")
+
+def precompute_calendar(years=None):
+    """
+    Досчитывает непосчитанные дни (начиная с текущего года) и пересчитывает
+    прошедшие дни, посчитанные по заменителю Kp, — например, после сбоя
+    xras.ru или простоя бота. Будущие дни ждут, пока не наступят.
+    years ограничивает расчёт частью календаря (по умолчанию — все годы).
+    """
+    today = datetime.datetime.now(pytz.UTC).date()
+    current_year = today.year
+    refreshed = False
+    years = [y for y in portal_calendar.years if years is None or y in years]
+    for year in sorted(years, key=lambda y: abs(y - current_year)):
+        stale = portal_calendar.stale_dates(year, today)
+        if not stale:
+            continue
+        logger.info(f"Календарь: считаем {len(stale)} дн. за {year}")
+        for i, date in enumerate(stale, 1):
+            compute_calendar_day(date)
+            refreshed = refreshed or date <= today
+            if i % 30 == 0:
+                portal_calendar.save()
+        portal_calendar.save()
+    if refreshed:
+        # В кэше анализа могли остаться результаты с устаревшим Kp
+        get_event_analysis.cache_clear()
+
+def run_calendar_job():
+    global portal_calendar
+    while True:
+        try:
+            if portal_calendar.years != get_offered_years():
+                # Сменился год — сдвигаем окно, посчитанные годы переносятся из файла
+                portal_calendar = PortalCalendar(CALENDAR_PATH, CITY_COORDS, get_offered_years())
+            precompute_calendar()
+        except Exception as e:
+            logger.error(f"Ошибка фонового расчёта календаря: {e}")
+        time.sleep(CALENDAR_REFRESH)
+
 async def analyze_period(city, portal_type, year, months):
     coords = CITY_COORDS.get(city)
     if not coords:
         raise Exception("Координаты города не найдены")
+    portal_calendar.reload_if_changed()
+    dates = portal_calendar.lookup(city, year, months, portal_type)
+    if dates is not None:
+        return [f"{d.day:02d}.{d.month:02d}.{year} — {PORTAL_LABELS[portal_type]}" for d in dates]
+
     lat, lon = coords
     results = []
     for month in months:
@@ -307,6 +440,198 @@ async def analyze_period(city, portal_type, year, months):
                 continue
     return results
 
+# === HTTP API (пакетная классификация) ===
+API_MAX_POINTS = 1000
+BATCH_WINDOW = 0.05  # сек — окно, в которое мелкие запросы склеиваются в один пакет
+API_MAX_DATES = 31  # различных дат в одном запросе /classify
+API_MAX_KP_FETCHES = 31  # новых запросов к xras.ru на один запрос API
+API_TIMEOUT = 30  # сек — общий срок на загрузку Kp и расчёт пакета, иначе 503
+# Годы, покрытые файлами эфемерид в ephemeris/ (sepl_18, semo_18)
+API_MIN_YEAR = 1800
+API_MAX_YEAR = 2399
+
+# Kp запрашивается в потоках запросов через небольшой пул, а не в потоке пакетов:
+# медленный xras.ru не должен задерживать чужие пакеты
+kp_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="kp")
+kp_inflight = {}  # date → Future загрузки, общей для всех запросов
+kp_inflight_lock = threading.Lock()
+
+def warm_kp_cache(dates, deadline):
+    """
+    Загружает в kp_cache Kp для дат запроса, не дольше deadline (time.monotonic).
+    Новых запросов к xras.ru — не больше API_MAX_KP_FETCHES, уже идущие
+    загрузки переиспользуются. False — Kp готов не для всех дат (ответ 503);
+    начатые загрузки продолжаются и пригодятся при повторном запросе.
+    Если xras.ru не ответил, в кэш попадает неокончательный 2.0 (на 10 минут).
+    """
+    todo = [d for d in sorted(set(dates)) if get_cached_kp(d) is None]
+    futures = []
+    with kp_inflight_lock:
+        started = 0
+        for date in todo:
+            future = kp_inflight.get(date)
+            if future is None or future.done():
+                if started >= API_MAX_KP_FETCHES:
+                    continue
+                future = kp_pool.submit(get_kp_status, date)
+                kp_inflight[date] = future
+                future.add_done_callback(lambda f, d=date: kp_inflight.pop(d, None))
+                started += 1
+            futures.append(future)
+    if futures:
+        wait(futures, timeout=max(0, deadline - time.monotonic()))
+    return len(futures) == len(todo) and all(f.done() for f in futures)
+
+def kp_not_ready():
+    return jsonify({"error": "Kp-индекс ещё загружается, повторите запрос позже"}), 503
+
+def classify_batch(points):
+    """
+    Классифицирует список точек (lat, lon, dt) одним проходом.
+    Одинаковые точки считаются один раз, результаты берутся из общего
+    кэша get_event_analysis. Kp для дат пакета должен быть уже прогрет.
+    """
+    unique = list(dict.fromkeys(points))
+    classified = {}
+    for lat, lon, dt in unique:
+        try:
+            classified[(lat, lon, dt)] = get_event_analysis(lat, lon, dt)
+        except Exception as e:
+            logger.warning(f"Ошибка классификации {lat}, {lon}, {dt}: {e}")
+            classified[(lat, lon, dt)] = None
+    return [classified[p] for p in points]
+
+class ClassifyBatcher:
+    """Склеивает конкурентные запросы API в общие пакеты для classify_batch"""
+
+    def __init__(self, window=BATCH_WINDOW, max_points=API_MAX_POINTS * 10):
+        self.window = window
+        self.max_points = max_points
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, points):
+        future = Future()
+        self._ensure_started()
+        self._queue.put((points, future))
+        return future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            total = len(pending[0][0])
+            deadline = time.monotonic() + self.window
+            while total < self.max_points:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                total += len(item[0])
+
+            merged = [p for points, _ in pending for p in points]
+            try:
+                results = classify_batch(merged)
+            except Exception as e:
+                logger.error(f"Ошибка пакетной классификации: {e}")
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            pos = 0
+            for points, future in pending:
+                future.set_result(results[pos:pos + len(points)])
+                pos += len(points)
+
+classify_batcher = ClassifyBatcher()
+
+def parse_api_point(item):
+    dt = datetime.datetime.fromisoformat(str(item["datetime"]))
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    else:
+        dt = dt.astimezone(pytz.utc)
+    lat = float(item["lat"])
+    lon = float(item["lon"])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("Координаты вне диапазона")
+    if not API_MIN_YEAR <= dt.year <= API_MAX_YEAR:
+        raise ValueError(f"Год вне диапазона {API_MIN_YEAR}–{API_MAX_YEAR}")
+    return lat, lon, dt
+
+@flask_app.route('/classify', methods=['POST'])
+def api_classify():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "Ожидается JSON-массив {datetime, lat, lon}"}), 400
+    if len(items) > API_MAX_POINTS:
+        return jsonify({"error": f"Не более {API_MAX_POINTS} точек за запрос"}), 400
+    try:
+        points = [parse_api_point(item) for item in items]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Некорректная точка: {e}"}), 400
+    dates = {dt.date() for _, _, dt in points}
+    if len(dates) > API_MAX_DATES:
+        return jsonify({"error": f"Не более {API_MAX_DATES} различных дат за запрос"}), 400
+
+    deadline = time.monotonic() + API_TIMEOUT
+    if not warm_kp_cache(dates, deadline):
+        return kp_not_ready()
+    try:
+        results = classify_batcher.submit(points).result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        return jsonify({"error": "Сервис перегружен, повторите запрос позже"}), 503
+    return jsonify({"results": [
+        {"datetime": dt.isoformat(), "lat": lat, "lon": lon, "type": event_type}
+        for (lat, lon, dt), event_type in zip(points, results)
+    ]})
+
+@flask_app.route('/calendar/<city>/<int:year>')
+def api_calendar(city, year):
+    coords = CITY_COORDS.get(city)
+    if not coords:
+        return jsonify({"error": "Координаты города не найдены"}), 404
+    if not API_MIN_YEAR <= year <= API_MAX_YEAR:
+        return jsonify({"error": f"Год вне диапазона {API_MIN_YEAR}–{API_MAX_YEAR}"}), 400
+    portal_type = request.args.get("type", type=int)
+    lat, lon = coords
+    start = datetime.date(year, 1, 1)
+    days = [start + datetime.timedelta(days=i) for i in range((datetime.date(year + 1, 1, 1) - start).days)]
+
+    # Посчитанные дни берём из календаря порталов, остальные считаем в потоке
+    # этого запроса, а не в общей очереди мелких запросов
+    deadline = time.monotonic() + API_TIMEOUT
+    portal_calendar.reload_if_changed()
+    event_types = {}
+    for d in days:
+        known = portal_calendar.get_type(city, d)
+        if known is not None:
+            event_types[d] = PORTAL_LABELS.get(known, NO_PORTAL)
+    todo = [d for d in days if d not in event_types]
+    if todo:
+        # Для непокрытого года Kp догружается частями: повторные запросы продолжают загрузку
+        if not warm_kp_cache(todo, deadline):
+            return kp_not_ready()
+        live = classify_batch([(lat, lon, calendar_day_dt(d)) for d in todo])
+        event_types.update(zip(todo, live))
+
+    calendar = []
+    for d in days:
+        event_type = event_types[d]
+        if portal_type is not None and (event_type is None or get_portal_type(event_type) != portal_type):
+            continue
+        calendar.append({"date": d.isoformat(), "type": event_type})
+    return jsonify({"city": city, "year": year, "days": calendar})
+
 # === ОБРАБОТЧИКИ ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -315,31 +640,87 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
+async def run_scan(user_data, year, months):
+    """
+    Выполняет поиск и отмечает его ход в сессии, чтобы другой воркер
+    или перезапущенный процесс видел незавершённый поиск
+    """
+    user_data["scan"] = {
+        "year": year, "months": months, "status": "running",
+        "pid": os.getpid(), "started_at": time.time()
+    }
+    user_data.save()
+    active_scans.add(user_data.user_id)
+    try:
+        results = await analyze_period(user_data["city"], user_data["portal_type"], year, months)
+        user_data.update({"results": results, "page": 0})
+        user_data["scan"]["status"] = "done"
+        return results
+    except Exception:
+        user_data["scan"]["status"] = "failed"
+        raise
+    finally:
+        active_scans.discard(user_data.user_id)
+        user_data.save()
+
+def is_scan_alive(user_data):
+    """Идёт ли сейчас поиск из сессии — в этом процессе или в другом воркере"""
+    scan = user_data.get("scan")
+    if not scan or scan["status"] != "running":
+        return False
+    if time.time() - scan.get("started_at", 0) > SCAN_TIMEOUT:
+        return False
+    if scan.get("pid") == os.getpid():
+        return user_data.user_id in active_scans
+    return True
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     # 🔥 Подтверждаем запрос БЕЗ уведомления → нет часиков, но нет и "Query is too old"
     await query.answer(text="")  # ← именно так
 
+    # Состояние берём из общего хранилища, а не из context.user_data — его видят все воркеры
+    user_data = session_store.load(update.effective_user.id)
+    try:
+        try:
+            await process_callback(query, user_data)
+        finally:
+            user_data.save()
+    except SessionConflict:
+        # Другой воркер уже изменил сессию (например, пользователь нажал «Отмена») — его состояние главнее
+        logger.info(f"Сессия пользователя {user_data.user_id} изменена параллельно, ответ отброшен")
+
+async def reply(query, user_data, text, **kwargs):
+    """
+    Сохраняет сессию и только потом редактирует сообщение: если другой воркер
+    успел изменить сессию, save() бросит SessionConflict и устаревший ответ не уйдёт
+    """
+    user_data.save()
+    await query.edit_message_text(text, **kwargs)
+
+async def process_callback(query, user_data):
     data = query.data
-    user_data = context.user_data
 
     if data == "cancel":
+        # Отмена побеждает всегда: удаляем сессию без сверки версии,
+        # параллельный поиск на другом воркере затем получит SessionConflict
+        user_data.clear()
+        user_data.discard()
         await query.edit_message_text(
             "🔚 Операция завершена.\nОтправьте /start для нового поиска.",
             reply_markup=None
         )
-        user_data.clear()
         return
 
     if data.startswith("cities:"):
         offset = int(data.split(":")[1])
-        await query.edit_message_text("Выберите город:", reply_markup=build_city_keyboard(offset))
+        await reply(query, user_data, "Выберите город:", reply_markup=build_city_keyboard(offset))
         return
 
     if data.startswith("city:"):
         city = data.split(":", 1)[1]
         user_data.update({"city": city})
-        await query.edit_message_text(
+        await reply(query, user_data,
             f"📍 Выбран город: <b>{city}</b>\nВыберите тип портала:",
             reply_markup=build_type_keyboard(),
             parse_mode="HTML"
@@ -349,28 +730,28 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("type:"):
         portal_type = int(data.split(":")[1])
         user_data["portal_type"] = portal_type
-        await query.edit_message_text("Выберите режим поиска:", reply_markup=build_search_mode_keyboard())
+        await reply(query, user_data, "Выберите режим поиска:", reply_markup=build_search_mode_keyboard())
         return
 
     if data.startswith("mode:"):
         mode = data.split(":")[1]
         user_data["mode"] = mode
         if mode == "single":
-            await query.edit_message_text("Выберите месяц:", reply_markup=build_single_month_keyboard())
+            await reply(query, user_data, "Выберите месяц:", reply_markup=build_single_month_keyboard())
         else:
-            await query.edit_message_text("Выберите квартал:", reply_markup=build_quarter_keyboard())
+            await reply(query, user_data, "Выберите квартал:", reply_markup=build_quarter_keyboard())
         return
 
     if data.startswith("month:"):
         month = int(data.split(":")[1])
         user_data["month"] = month
-        await query.edit_message_text("Выберите год:", reply_markup=build_year_keyboard())
+        await reply(query, user_data, "Выберите год:", reply_markup=build_year_keyboard())
         return
 
     if data.startswith("quarter:"):
         quarter = int(data.split(":")[1])
         user_data["quarter"] = quarter
-        await query.edit_message_text("Выберите год:", reply_markup=build_year_keyboard())
+        await reply(query, user_data, "Выберите год:", reply_markup=build_year_keyboard())
         return
 
     if data.startswith("year:"):
@@ -381,29 +762,43 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         portal_type = user_data.get("portal_type")
 
         if not all([city, portal_type, mode]):
-            await query.edit_message_text("❌ Ошибка состояния. Отправьте /start.")
+            await reply(query, user_data, "❌ Ошибка состояния. Отправьте /start.")
             return
 
         try:
             if mode == "single":
                 month = user_data["month"]
-                results = await analyze_period(city, portal_type, year, [month])
-                user_data.update({"results": results, "page": 0})
+                await run_scan(user_data, year, [month])
                 await show_results(query, user_data, mode="single", current_month=month, year=year, city=city)
             else:
                 quarter = user_data["quarter"]
                 quarters = {1: [1,2,3], 2: [4,5,6], 3: [7,8,9], 4: [10,11,12]}
                 months = quarters[quarter]
-                results = await analyze_period(city, portal_type, year, months)
-                user_data.update({"results": results, "page": 0})
+                await run_scan(user_data, year, months)
                 await show_results(query, user_data, mode="quarter", current_quarter=quarter, year=year, city=city)
+        except SessionConflict:
+            raise
         except Exception as e:
             logger.error(f"Ошибка анализа: {e}")
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await reply(query, user_data, f"❌ Ошибка: {e}")
         return
 
     if data.startswith("page:"):
         page = int(data.split(":")[1])
+        scan = user_data.get("scan")
+        if scan and scan["status"] == "running":
+            if is_scan_alive(user_data):
+                await reply(query, user_data, "⏳ Поиск ещё выполняется, попробуйте через несколько секунд.")
+                return
+            # Поиск прервался (рестарт или падение воркера) — досчитываем по сохранённым параметрам
+            try:
+                await run_scan(user_data, scan["year"], scan["months"])
+            except SessionConflict:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка повторного анализа: {e}")
+                await reply(query, user_data, f"❌ Ошибка: {e}")
+                return
         user_data["page"] = max(0, page)
         mode = user_data.get("mode", "single")
         current_month = user_data.get("month")
@@ -421,11 +816,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         city = user_data["city"]
         portal_type = user_data["portal_type"]
         try:
-            results = await analyze_period(city, portal_type, year, [month])
-            user_data.update({"results": results, "page": 0, "mode": "single"})
+            user_data["mode"] = "single"
+            await run_scan(user_data, year, [month])
             await show_results(query, user_data, mode="single", current_month=month, year=year, city=city)
+        except SessionConflict:
+            raise
         except Exception as e:
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await reply(query, user_data, f"❌ Ошибка: {e}")
         return
 
     if data.startswith("next_quarter:"):
@@ -438,11 +835,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         city = user_data["city"]
         portal_type = user_data["portal_type"]
         try:
-            results = await analyze_period(city, portal_type, year, months)
-            user_data.update({"results": results, "page": 0, "mode": "quarter"})
+            user_data["mode"] = "quarter"
+            await run_scan(user_data, year, months)
             await show_results(query, user_data, mode="quarter", current_quarter=quarter, year=year, city=city)
+        except SessionConflict:
+            raise
         except Exception as e:
-            await query.edit_message_text(f"❌ Ошибка: {e}")
+            await reply(query, user_data, f"❌ Ошибка: {e}")
         return
 
 async def show_results(query, user_data, mode, current_month=None, current_quarter=None, year=None, city=None):
@@ -467,6 +866,7 @@ async def show_results(query, user_data, mode, current_month=None, current_quart
         current_month=current_month, current_quarter=current_quarter, year=year, city=city
     )
 
+    user_data.save()  # при конфликте SessionConflict уходит мимо except ниже — ответ не отправляется
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
     except Exception as e:
@@ -535,20 +935,62 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # === ЗАПУСК ===
-if __name__ == "__main__":
-    TOKEN = os.environ["TELEGRAM_TOKEN"]
-    app = Application.builder().token(TOKEN).build()
+def build_application(token, base_url=None):
+    builder = Application.builder().token(token)
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(handle_callback))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(MessageHandler(filters.Regex(r'\d+\s+\w+,\s+[\w\s]+'), manual_search))
+    return app
+
+def bind_webhook_socket(port):
+    """Общий слушающий сокет: воркеры после fork принимают соединения с него по очереди"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(128)
+    sock.setblocking(False)
+    return sock
+
+def run_webhook_worker(token, sock, webhook_url, worker_id):
+    logger.info(f"🧵 Webhook-воркер {worker_id} запущен (pid {os.getpid()}).")
+    app = build_application(token)
+    # Все воркеры ставят один и тот же webhook — повторный setWebhook безвреден
+    app.run_webhook(
+        unix=sock,
+        url_path=urlparse(webhook_url).path.lstrip("/"),
+        webhook_url=webhook_url,
+        secret_token=os.getenv("WEBHOOK_SECRET"),
+    )
 
-    # Flask в фоне
+if __name__ == "__main__":
+    TOKEN = os.environ["TELEGRAM_TOKEN"]
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+
+    session_store.purge(SESSION_TTL)
+
+    # Webhook-воркеры форкаем до запуска фоновых потоков
+    workers = []
+    if WEBHOOK_URL:
+        sock = bind_webhook_socket(int(os.getenv("WEBHOOK_PORT", 8443)))
+        fork = multiprocessing.get_context("fork")
+        for worker_id in range(int(os.getenv("WEBHOOK_WORKERS", 1))):
+            worker = fork.Process(target=run_webhook_worker, args=(TOKEN, sock, WEBHOOK_URL, worker_id))
+            worker.start()
+            workers.append(worker)
+
+    # Flask (health check + JSON API) в фоне
     def run_flask():
-        flask_app.run(host='0.0.0.0', port=int(os.getenv('PORT', 10000)))
+        flask_app.run(host='0.0.0.0', port=int(os.getenv('PORT', 10000)), threaded=True)
     threading.Thread(target=run_flask, daemon=True).start()
 
+    # Календарь порталов считается в основном процессе, воркеры читают файл
+    threading.Thread(target=run_calendar_job, daemon=True).start()
+
     # Heartbeat
     def run_heartbeat():
         while True:
@@ -556,5 +998,10 @@ if __name__ == "__main__":
             print("heartbeat")
     threading.Thread(target=run_heartbeat, daemon=True).start()
 
-    logger.info("🚀 JyotishPortal Bot запущен (БЕЗ ЧАСИКОВ + ТОЛЬКО bot.log + ГОРОД В ЗАГОЛОВКЕ).")
-    app.run_polling()
\ No newline at end of file
+    if WEBHOOK_URL:
+        logger.info(f"🚀 JyotishPortal Bot запущен в режиме webhook ({len(workers)} воркеров).")
+        for worker in workers:
+            worker.join()
+    else:
+        logger.info("🚀 JyotishPortal Bot запущен (БЕЗ ЧАСИКОВ + ТОЛЬКО bot.log + ГОРОД В ЗАГОЛОВКЕ).")
+        build_application(TOKEN).run_polling()
@@ -1,6 +1,8 @@
 import swisseph as swe
 import logging
+from bisect import bisect_right
 from datetime import datetime
+from functools import lru_cache
 import pytz
 
 # Настройка логирования
@@ -99,23 +101,48 @@ def get_zodiac_sign(pos):
 def get_moon_house(moon_pos, houses):
     """Определяет дом Луны по системе Кришнамурти"""
     try:
-        for i in range(12):
-            start = houses[i]
-            end = houses[(i + 1) % 12]
-            
-            if start < end:
-                if start <= moon_pos < end:
-                    return i + 1
-            else:
-                # Пересечение 0°
-                if moon_pos >= start or moon_pos < end:
-                    return i + 1
-        logger.warning(f"Дом Луны не определён: {moon_pos}°, дома: {houses}")
-        return None
+        house = get_house_indices([moon_pos], houses)[0]
+        if house is None:
+            logger.warning(f"Дом Луны не определён: {moon_pos}°, дома: {houses}")
+        return house
     except Exception as e:
         logger.error(f"Ошибка определения дома Луны: {e}")
         return None
 
+def get_house_indices(longitudes, houses):
+    """
+    Определяет дома (1–12) для массива долгот за один проход.
+
+    Куспиды поворачиваются так, чтобы начинаться с наименьшего, — получается
+    отсортированный список, в котором дом ищется бинарным поиском.
+    Долгота меньше наименьшего куспида попадает в дом, пересекающий 0°.
+    """
+    start = min(range(12), key=lambda i: houses[i])
+    rotated = [houses[(start + i) % 12] for i in range(12)]
+    if any(rotated[i] > rotated[i + 1] for i in range(11)):
+        # Куспиды не по порядку (вырожденные дома) — проверяем каждый отрезок
+        return [_find_house_linear(lon % 360, houses) for lon in longitudes]
+
+    result = []
+    for lon in longitudes:
+        pos = bisect_right(rotated, lon % 360) - 1  # -1 → последний отрезок, через 0°
+        result.append((start + pos) % 12 + 1)
+    return result
+
+def _find_house_linear(lon, houses):
+    for i in range(12):
+        start = houses[i]
+        end = houses[(i + 1) % 12]
+
+        if start < end:
+            if start <= lon < end:
+                return i + 1
+        else:
+            # Пересечение 0°
+            if lon >= start or lon < end:
+                return i + 1
+    return None
+
 def get_houses_kp(lat, lon, jd):
     """
     Рассчитывает дома по системе Кришнамурти (KP)
@@ -128,26 +155,53 @@ def get_houses_kp(lat, lon, jd):
         house_cusps, ascmc = swe.houses(jd, lat, lon, b'P')
         
         # Возвращаем только первые 12 куспидов (домов)
-        return house_cusps[:12]
+        return list(house_cusps[:12])
     except Exception as e:
         logger.error(f"Ошибка расчёта домов KP: {e}")
         return get_houses_fallback(lat, lon, jd)
 
+def get_houses_batch(charts):
+    """
+    Рассчитывает куспиды для множества карт (jd, lat, lon) за один вызов.
+
+    Результат точный (как у get_houses_kp): кэш ключуется по точным jd и
+    координатам, поэтому экономия есть только на повторяющихся картах.
+    Каждая новая карта — по-прежнему один вызов swe.houses; округление
+    времени или места здесь недопустимо: в широтах городов бота (50–66°)
+    минута сдвигает куспиды Плацидуса до 1.5°.
+    """
+    return [list(_houses_cached(lat, lon, jd)) for jd, lat, lon in charts]
+
+def get_moon_houses_batch(charts):
+    """
+    Дома Луны для множества карт (jd, lat, lon) — для сканирования диапазонов дат.
+    Повторяющиеся карты считаются один раз; при сканировании по дням каждая
+    дата — отдельная карта, так что это один swe.houses и один поиск на день.
+    """
+    groups = {}
+    for i, chart in enumerate(charts):
+        groups.setdefault(chart, []).append(i)
+
+    result = [None] * len(charts)
+    for (jd, lat, lon), members in groups.items():
+        moon_pos = swe.calc_ut(jd, swe.MOON)[0][0] % 360
+        house = get_house_indices([moon_pos], _houses_cached(lat, lon, jd))[0]
+        for i in members:
+            result[i] = house
+    return result
+
+@lru_cache(maxsize=8192)
+def _houses_cached(lat, lon, jd):
+    return tuple(get_houses_kp(lat, lon, jd))
+
 def get_houses_fallback(lat, lon, jd):
     """
     Резервный метод расчёта домов, если основной не сработал
     """
     try:
-        # Получаем положение Асцендента
-        asce = swe.calc_ut(jd, swe.ASC)[0][0] % 360
-        
-        # Рассчитываем 12 домов по равным 30°
-        houses = []
-        for i in range(12):
-            house_start = (asce + i * 30) % 360
-            houses.append(house_start)
-        
-        return houses
+        # Равнодомная система (b'E') от Асцендента — считается и в полярных широтах
+        house_cusps, ascmc = swe.houses(jd, lat, lon, b'E')
+        return list(house_cusps[:12])
     except Exception as e:
         logger.error(f"Ошибка резервного расчёта домов: {e}")
         return [i * 30 for i in range(12)]  # Резерв: равные дома
@@ -0,0 +1,303 @@
+"""
+Нагрузочный тест бота без Telegram и внешних сервисов.
+
+Поднимает локальные заглушки Bot API, Kp-индекса и геокодера, запускает
+настоящий Application из bot.py и имитирует N пользователей, которые
+проходят город → тип → режим → месяц/квартал → год и листают страницы.
+В конце печатает p50/p99 задержки ответа на нажатие, пропускную способность
+и рост памяти (сессии, кэши) во времени.
+
+Пример:
+    python loadtest.py --users 50 --rounds 3 --pages 2
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = "123456:LOADTEST"
+
+def start_server(handler_cls):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class JSONHandler(BaseHTTPRequestHandler):
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # без вывода каждого запроса
+
+# === ЗАГЛУШКА ГЕОКОДЕРА (Nominatim /search) ===
+class GeocoderHandler(JSONHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+        # Детерминированные координаты в пределах России
+        digest = hashlib.md5(query.encode("utf-8")).digest()
+        lat = 42 + digest[0] / 255 * 28
+        lon = 30 + digest[1] / 255 * 140
+        self.send_json([{
+            "lat": str(lat), "lon": str(lon), "display_name": query,
+            "place_id": 1, "boundingbox": [str(lat), str(lat), str(lon), str(lon)]
+        }])
+
+# === ЗАГЛУШКА Kp-ИНДЕКСА (формат xras.ru) ===
+class KpHandler(JSONHandler):
+    def do_GET(self):
+        date_str = urlparse(self.path).path.rsplit("_", 1)[-1].split(".")[0]
+        day = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
+        rnd = random.Random(date_str)
+        row = {"time": day}
+        for h in range(0, 24, 3):
+            row[f"h{h:02d}"] = f"{rnd.uniform(0, 7):.1f}"
+        self.send_json({"data": [row]})
+
+# === ЗАГЛУШКА TELEGRAM BOT API ===
+class FakeBotAPI:
+    """
+    Отдаёт боту обновления через getUpdates и фиксирует его ответы.
+    Ответом на нажатие считается editMessageText в чат пользователя.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.cond = threading.Condition()
+        self.next_update_id = 1
+        self.pending = {}  # chat_id → (threading.Event, список для времени ответа)
+        self.calls = defaultdict(int)
+
+    def push_callback(self, user_id, data):
+        event = threading.Event()
+        reply = []
+        with self.cond:
+            self.pending[user_id] = (event, reply)
+            self.updates.append({
+                "update_id": self.next_update_id,
+                "callback_query": {
+                    "id": str(self.next_update_id),
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                    "chat_instance": str(user_id),
+                    "data": data,
+                    "message": {
+                        "message_id": 1, "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "text": "…"
+                    }
+                }
+            })
+            self.next_update_id += 1
+            self.cond.notify_all()
+        return event, reply
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return list(self.updates)
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method == "getUpdates":
+            return self.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        if method in ("editMessageText", "sendMessage"):
+            chat_id = int(params.get("chat_id"))
+            with self.cond:
+                event, reply = self.pending.pop(chat_id, (None, None))
+            if event:
+                reply.append(time.perf_counter())
+                event.set()
+            return {"message_id": 1, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True  # deleteWebhook, answerCallbackQuery и прочее
+
+def make_bot_api_handler(api):
+    class BotAPIHandler(JSONHandler):
+        def do_POST(self):
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length).decode("utf-8") if length else ""
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params = json.loads(raw or "{}")
+            else:
+                params = {}
+                for key, values in parse_qs(raw).items():
+                    try:
+                        params[key] = json.loads(values[0])
+                    except ValueError:
+                        params[key] = values[0]
+            self.send_json({"ok": True, "result": api.handle(method, params)})
+
+        do_GET = do_POST
+    return BotAPIHandler
+
+# === СЦЕНАРИЙ ПОЛЬЗОВАТЕЛЯ ===
+def user_clicks(bot, rnd, pages, years):
+    """Последовательность нажатий одного прохода по меню"""
+    clicks = [f"city:{rnd.choice(list(bot.CITY_COORDS))}", f"type:{rnd.choice([1, 2, 4])}"]
+    if rnd.random() < 0.5:
+        clicks += ["mode:single", f"month:{rnd.randint(1, 12)}"]
+    else:
+        clicks += ["mode:quarter", f"quarter:{rnd.randint(1, 4)}"]
+    clicks.append(f"year:{rnd.choice(years)}")
+    for page in range(1, pages + 1):
+        clicks.append(f"page:{page}")
+    clicks.append("page:0")
+    clicks.append("cancel")
+    return clicks
+
+def run_user(api, bot, user_id, args, latencies, errors):
+    rnd = random.Random(user_id)
+    for _ in range(args.rounds):
+        for data in user_clicks(bot, rnd, args.pages, args.years):
+            sent = time.perf_counter()
+            event, reply = api.push_callback(user_id, data)
+            if not event.wait(args.reply_timeout):
+                errors.append(data)
+                continue
+            latencies[data.split(":")[0]].append(reply[0] - sent)
+            time.sleep(rnd.uniform(0, args.think_time))
+
+# === ЗАМЕРЫ ===
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def sample_memory(bot):
+    current, _ = tracemalloc.get_traced_memory()
+    return {
+        "heap_mb": current / 2**20,
+        "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "sessions": len(bot.session_store),
+        "session_kb": bot.session_store.payload_size() / 1024,
+        "analysis_cache": bot.get_event_analysis.cache_info().currsize,
+        "kp_cache": len(bot.kp_cache),
+    }
+
+async def run_load(args):
+    api = FakeBotAPI()
+    bot_api = start_server(make_bot_api_handler(api))
+    geocoder = start_server(GeocoderHandler)
+    kp = start_server(KpHandler)
+
+    workdir = tempfile.mkdtemp(prefix="jyotish_loadtest_")
+    os.environ.update({
+        "NOMINATIM_DOMAIN": f"127.0.0.1:{geocoder.server_port}",
+        "NOMINATIM_SCHEME": "http",
+        "KP_URL_TEMPLATE": f"http://127.0.0.1:{kp.server_port}/txt/kp_BPE3_{{date}}.json",
+        "SESSION_STORE": args.session_store,
+        "SESSION_DB": os.path.join(workdir, "sessions.db"),
+        "CALENDAR_PATH": os.path.join(workdir, "portal_calendar.bin"),
+    })
+    os.chdir(workdir)  # bot.log и прочие файлы — во временный каталог
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    offered = bot.get_offered_years()
+    args.years = args.years or [datetime.date.today().year]
+    if not set(args.years) <= set(offered):
+        raise SystemExit(f"--years: доступны только {offered[0]}–{offered[-1]}")
+    if args.calendar:
+        print(f"Считаем календарь порталов за {', '.join(map(str, args.years))}…")
+        bot.precompute_calendar(args.years)
+
+    app = bot.build_application(TOKEN, base_url=f"http://127.0.0.1:{bot_api.server_port}/bot")
+    tracemalloc.start()
+    samples = []
+    latencies = defaultdict(list)
+    errors = []
+    done = threading.Event()
+
+    def sampler():
+        started = time.perf_counter()
+        while not done.is_set():
+            samples.append((time.perf_counter() - started, sample_memory(bot)))
+            done.wait(args.sample_interval)
+        samples.append((time.perf_counter() - started, sample_memory(bot)))
+
+    def drive_users():
+        threads = []
+        for i in range(args.users):
+            t = threading.Thread(target=run_user, args=(api, bot, 1000 + i, args, latencies, errors), daemon=True)
+            threads.append(t)
+            t.start()
+            time.sleep(args.ramp_up / max(args.users, 1))
+        for t in threads:
+            t.join()
+
+    async with app:
+        await app.start()
+        await app.updater.start_polling(poll_interval=0, timeout=1)
+        threading.Thread(target=sampler, daemon=True).start()
+        started = time.perf_counter()
+        await asyncio.to_thread(drive_users)
+        elapsed = time.perf_counter() - started
+        done.set()
+        await app.updater.stop()
+        await app.stop()
+
+    report(latencies, errors, elapsed, samples, api, workdir)
+
+def report(latencies, errors, elapsed, samples, api, workdir):
+    total = sum(len(v) for v in latencies.values())
+    print(f"\nНажатий: {total}, без ответа: {len(errors)}, время: {elapsed:.1f} с, "
+          f"пропускная способность: {total / elapsed:.1f} нажатий/с")
+    print(f"\n{'действие':<14}{'n':>7}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    rows = sorted(latencies.items()) + [("всего", [x for v in latencies.values() for x in v])]
+    for action, values in rows:
+        if values:
+            print(f"{action:<14}{len(values):>7}{percentile(values, 0.5) * 1000:>10.1f}"
+                  f"{percentile(values, 0.99) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+
+    print(f"\n{'t, с':>7}{'heap, МБ':>10}{'rss, МБ':>10}{'сессии':>9}{'сессии, КБ':>12}"
+          f"{'кэш анализа':>13}{'kp_cache':>10}")
+    for t, s in samples:
+        print(f"{t:>7.1f}{s['heap_mb']:>10.1f}{s['maxrss_mb']:>10.1f}{s['sessions']:>9}"
+              f"{s['session_kb']:>12.1f}{s['analysis_cache']:>13}{s['kp_cache']:>10}")
+    print(f"\nВызовы Bot API: {dict(api.calls)}")
+    print(f"Рабочий каталог (bot.log, сессии): {workdir}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест JyotishPortal_Bot на локальных заглушках")
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=2, help="проходов по меню на пользователя")
+    parser.add_argument("--pages", type=int, default=2, help="листаний страниц результатов за проход")
+    parser.add_argument("--think-time", type=float, default=0.2, help="макс. пауза между нажатиями, с")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="сколько ждать ответа на нажатие, с")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="период замеров памяти, с")
+    parser.add_argument("--session-store", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--years", type=int, nargs="+",
+                        help="годы, которые выбирают пользователи (по умолчанию — текущий)")
+    parser.add_argument("--calendar", action="store_true",
+                        help="заранее посчитать календарь порталов за годы из --years")
+    asyncio.run(run_load(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import datetime
+import logging
+import os
+import struct
+import threading
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Битовая маска дня: тип портала → бит, старший бит — «день уже посчитан»,
+# следующий — «посчитан по окончательному Kp» (иначе день будет пересчитан)
+TYPE_BITS = {1: 0x01, 2: 0x02, 4: 0x04, 5: 0x08}
+KP_FINAL = 0x40
+COMPUTED = 0x80
+DAYS_PER_YEAR = 366
+
+MAGIC = b"JPCAL1"
+HEADER = struct.Struct("<6sHHHI")  # магия, первый год, число лет, число городов, длина списка городов
+
+class PortalCalendar:
+    """
+    Материализованный календарь порталов: город × день × битовая маска типов.
+
+    Хранится в одном компактном файле: заголовок, список городов и плоский
+    массив байтов, по одному на день (366 на год). Смещение дня вычисляется
+    по индексу города, году и номеру дня в году — поиск без перебора.
+    """
+
+    def __init__(self, path, cities, years):
+        self.path = path
+        self.cities = list(cities)
+        self.years = list(range(min(years), max(years) + 1))
+        self._city_index = {city: i for i, city in enumerate(self.cities)}
+        self._data = bytearray(len(self.cities) * len(self.years) * DAYS_PER_YEAR)
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _offset(self, city, date):
+        ci = self._city_index.get(city)
+        if ci is None or not self.years[0] <= date.year <= self.years[-1]:
+            return None
+        day = date.timetuple().tm_yday - 1
+        return (ci * len(self.years) + date.year - self.years[0]) * DAYS_PER_YEAR + day
+
+    def get(self, city, date):
+        """Маска дня или None, если день ещё не посчитан / вне календаря"""
+        offset = self._offset(city, date)
+        if offset is None or not self._data[offset] & COMPUTED:
+            return None
+        return self._data[offset]
+
+    def get_type(self, city, date):
+        """Тип портала за день: номер типа, 0 — вне системы, None — не посчитан"""
+        mask = self.get(city, date)
+        if mask is None:
+            return None
+        for portal_type, bit in TYPE_BITS.items():
+            if mask & bit:
+                return portal_type
+        return 0
+
+    def set(self, city, date, portal_type, kp_final):
+        """Записывает день; portal_type=None — «вне системы»"""
+        offset = self._offset(city, date)
+        if offset is not None:
+            self._data[offset] = COMPUTED | (KP_FINAL if kp_final else 0) | TYPE_BITS.get(portal_type, 0)
+
+    def lookup(self, city, year, months, portal_type):
+        """
+        Даты месяцев, в которые есть портал нужного типа.
+        Возвращает None, если хотя бы один день диапазона ещё не посчитан.
+        """
+        bit = TYPE_BITS[portal_type]
+        found = []
+        for month in months:
+            date = datetime.date(year, month, 1)
+            while date.month == month:
+                mask = self.get(city, date)
+                if mask is None:
+                    return None
+                if mask & bit:
+                    found.append(date)
+                date += datetime.timedelta(days=1)
+        return found
+
+    def load(self):
+        """Читает файл и переносит из него пересекающиеся города и годы"""
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            self._mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        try:
+            magic, first_year, n_years, n_cities, names_len = HEADER.unpack_from(raw)
+            if magic != MAGIC:
+                raise ValueError("неизвестный формат")
+            names = raw[HEADER.size:HEADER.size + names_len].decode("utf-8").split("\n")
+            data = memoryview(raw)[HEADER.size + names_len:]
+            if len(names) != n_cities or len(data) != n_cities * n_years * DAYS_PER_YEAR:
+                raise ValueError("размер не совпадает с заголовком")
+        except (struct.error, ValueError, UnicodeDecodeError) as e:
+            logger.warning(f"Календарь {self.path} повреждён, пересчитываем: {e}")
+            return
+
+        with self._lock:
+            for old_ci, city in enumerate(names):
+                if city not in self._city_index:
+                    continue
+                for year in self.years:
+                    if not first_year <= year < first_year + n_years:
+                        continue
+                    src = (old_ci * n_years + year - first_year) * DAYS_PER_YEAR
+                    dst = self._offset(city, datetime.date(year, 1, 1))
+                    self._data[dst:dst + DAYS_PER_YEAR] = data[src:src + DAYS_PER_YEAR]
+
+    def reload_if_changed(self):
+        """Подхватывает файл, обновлённый другим процессом"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.load()
+
+    def save(self):
+        """Атомарно записывает календарь (через временный файл и rename)"""
+        names = "\n".join(self.cities).encode("utf-8")
+        header = HEADER.pack(MAGIC, self.years[0], len(self.years), len(self.cities), len(names))
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        with self._lock:
+            with open(tmp_path, "wb") as f:
+                f.write(header)
+                f.write(names)
+                f.write(self._data)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    def stale_dates(self, year, today):
+        """
+        Дни года, которые нужно (пере)считать хотя бы для одного города:
+        ещё не посчитанные, а также прошедшие дни (включая today),
+        посчитанные по заменителю Kp — настоящие данные могли появиться.
+        """
+        date = datetime.date(year, 1, 1)
+        stale = []
+        while date.year == year:
+            for city in self.cities:
+                mask = self.get(city, date)
+                if mask is None or (date <= today and not mask & KP_FINAL):
+                    stale.append(date)
+                    break
+            date += datetime.timedelta(days=1)
+        return stale
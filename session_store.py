@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+class SessionConflict(Exception):
+    """Сессию изменил или удалил другой обработчик после того, как мы её прочитали"""
+
+class Session(dict):
+    """
+    Состояние пользователя (выбор города, режима, результаты, пагинация).
+    Ведёт себя как обычный user_data, но умеет сохранять себя в хранилище.
+    Сохранение проходит, только если с момента чтения сессию никто не менял.
+    """
+
+    def __init__(self, store, user_id, data=None, version=None):
+        super().__init__(data or {})
+        self.store = store
+        self.user_id = user_id
+        self.version = version
+
+    def save(self):
+        self.version = self.store.save(self.user_id, self, self.version)
+
+    def discard(self):
+        """Удаляет сессию без сверки версии (отмена должна побеждать всегда)"""
+        self.store.delete(self.user_id)
+        self.version = None
+
+class SessionStore(ABC):
+    """
+    Базовое хранилище сессий: load/save по user_id.
+
+    У каждой записи есть версия (случайный токен, новый при каждой записи).
+    save и delete проходят, только если версия в хранилище совпадает
+    с прочитанной, иначе — SessionConflict.
+    """
+
+    def load(self, user_id):
+        data, version = self._read(user_id)
+        return Session(self, user_id, data, version)
+
+    def save(self, user_id, data, version):
+        """Сохраняет сессию и возвращает её новую версию; пустая сессия удаляется"""
+        if data:
+            new_version = uuid.uuid4().hex
+            if not self._write(user_id, dict(data), version, new_version):
+                raise SessionConflict(user_id)
+            return new_version
+        if version is not None and not self._delete(user_id, version):
+            raise SessionConflict(user_id)
+        return None
+
+    @abstractmethod
+    def delete(self, user_id):
+        """Удаляет сессию без сверки версии"""
+
+    @abstractmethod
+    def purge(self, max_age):
+        """Удаляет сессии, не менявшиеся дольше max_age секунд"""
+
+    @abstractmethod
+    def __len__(self):
+        """Число сохранённых сессий"""
+
+    @abstractmethod
+    def payload_size(self):
+        """Суммарный размер сохранённых сессий в байтах JSON"""
+
+    @abstractmethod
+    def _read(self, user_id):
+        """(данные, версия) или (None, None), если сессии нет"""
+
+    @abstractmethod
+    def _write(self, user_id, data, version, new_version):
+        """Записывает данные, если текущая версия равна version (None — записи нет)"""
+
+    @abstractmethod
+    def _delete(self, user_id, version):
+        """Удаляет запись, если её текущая версия равна version"""
+
+class MemorySessionStore(SessionStore):
+    """Сессии в памяти процесса — только для одного воркера, теряются при рестарте"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def purge(self, max_age):
+        border = time.time() - max_age
+        with self._lock:
+            for user_id in [u for u, (_, _, ts) in self._sessions.items() if ts < border]:
+                del self._sessions[user_id]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def payload_size(self):
+        return sum(len(data.encode("utf-8")) for data, _, _ in list(self._sessions.values()))
+
+    def _read(self, user_id):
+        data, version, _ = self._sessions.get(user_id, (None, None, 0))
+        return (json.loads(data) if data else None), version
+
+    def _write(self, user_id, data, version, new_version):
+        with self._lock:
+            if self._sessions.get(user_id, (None, None, 0))[1] != version:
+                return False
+            # Храним JSON, чтобы поведение совпадало с SQLite (копия, а не общая ссылка)
+            self._sessions[user_id] = (json.dumps(data, ensure_ascii=False), new_version, time.time())
+            return True
+
+    def _delete(self, user_id, version):
+        with self._lock:
+            if self._sessions.get(user_id, (None, None, 0))[1] != version:
+                return False
+            del self._sessions[user_id]
+            return True
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Сессии в SQLite-файле. Файл общий для всех воркеров на машине,
+    WAL-режим позволяет читать параллельно с записью.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "version TEXT NOT NULL DEFAULT '')"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "version" not in columns:
+                # Файл от версии без CAS
+                conn.execute("ALTER TABLE sessions ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+
+    def _connect(self):
+        # Соединение на поток и на процесс: после fork воркер открывает своё
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def delete(self, user_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge(self, max_age):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age,))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def payload_size(self):
+        return self._connect().execute(
+            "SELECT COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM sessions"
+        ).fetchone()[0]
+
+    def _read(self, user_id):
+        row = self._connect().execute(
+            "SELECT data, version FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if not row:
+            return None, None
+        try:
+            return json.loads(row[0]), row[1]
+        except ValueError:
+            logger.warning(f"Повреждённая сессия пользователя {user_id}, сбрасываем")
+            return None, row[1]
+
+    def _write(self, user_id, data, version, new_version):
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._connect() as conn:
+            if version is None:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO sessions (user_id, data, updated_at, version) "
+                    "VALUES (?, ?, ?, ?)",
+                    (user_id, payload, time.time(), new_version)
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE sessions SET data = ?, updated_at = ?, version = ? "
+                    "WHERE user_id = ? AND version = ?",
+                    (payload, time.time(), new_version, user_id, version)
+                )
+            return cursor.rowcount == 1
+
+    def _delete(self, user_id, version):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM sessions WHERE user_id = ? AND version = ?", (user_id, version)
+            )
+            return cursor.rowcount == 1
+
+def create_session_store():
+    """
+    Создаёт хранилище по переменным окружения:
+    SESSION_STORE=sqlite (по умолчанию) | memory, SESSION_DB — путь к файлу SQLite.
+    """
+    kind = os.getenv("SESSION_STORE", "sqlite")
+    if kind == "memory":
+        return MemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore(os.getenv("SESSION_DB", "sessions.db"))
+    raise ValueError(f"Неизвестное хранилище сессий: {kind}")